@@ -5,154 +5,107 @@ Stage 1 of the ControlNet dataset pipeline (Multi-Mesh Version).
 
 Responsibility: Use Mitsuba 3 to render various cloth meshes with randomised
 lighting, materials, and geometry. Each frame produces TWO image files:
-  - dataset/renders/render_XXXX.png  → beauty (ControlNet target / output)
+  - dataset/renders/render_XXXX.webp → beauty (ControlNet target / output)
   - dataset/ao/ao_XXXX.png          → ambient occlusion pass (used by Stage 2)
 """
 
+import argparse
+import os
+
+from scene_utils import init_mitsuba, N_PHYS  # noqa: E402 — sets OMP env
+
 import mitsuba as mi
+import drjit as dr
 import numpy as np
 import cv2
-import os
 import json
-import random
 import glob
 import math
+import hashlib
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-mi.set_variant('scalar_rgb')
+# Optional: Intel Open Image Denoise (pip install oidn). When present, frames
+# are rendered at a fraction of the sample count and denoised instead —
+# path-traced noise falls off as 1/sqrt(spp), so the last few spp doublings
+# are the expensive ones and a denoiser buys them back almost for free.
+try:
+    import oidn
+    HAVE_OIDN = True
+except ImportError:
+    HAVE_OIDN = False
 
 # ---------------------------------------------------------------------------
 # 1. PATH RESOLUTION & DIRECTORY SETUP
 # ---------------------------------------------------------------------------
 BASE_DIR      = os.path.dirname(os.path.abspath(__file__))
 # NEW: Pointing to a folder full of diverse .obj files instead of a single scarf
-MESHES_DIR    = os.path.join(BASE_DIR, "cloth_meshes") 
+MESHES_DIR    = os.path.join(BASE_DIR, "cloth_meshes")
 DATASET_DIR   = os.path.join(BASE_DIR, "dataset")
 RENDERS_DIR   = os.path.join(DATASET_DIR, "renders")
 AO_DIR        = os.path.join(DATASET_DIR, "ao")
+# Binary mesh cache: OBJ is a slow text format, so each mesh is converted to
+# binary PLY once and re-runs load the PLY instead. Files are keyed by a hash
+# of the OBJ contents so editing a mesh invalidates its cache entry.
+MESH_CACHE_DIR = os.path.join(MESHES_DIR, ".cache")
 
 for d in (RENDERS_DIR, AO_DIR, MESHES_DIR):
     os.makedirs(d, exist_ok=True)
 
-# Discover all .obj files in the meshes directory
-mesh_files = sorted(glob.glob(os.path.join(MESHES_DIR, "*.obj")))
-
-print("--- PATH DIAGNOSTICS ---")
-print(f"Meshes dir : {MESHES_DIR}")
-print(f"  Found    : {len(mesh_files)} .obj file(s)")
-print(f"Renders dir: {RENDERS_DIR}")
-print(f"AO dir     : {AO_DIR}")
-print("------------------------\n")
+# Shared variant/thread/flag/resolver setup — runs once per process,
+# including each render worker (they re-import this module)
+init_mitsuba(resolver_paths=(MESHES_DIR,))
 
-if not mesh_files:
-    print(f"[ERROR] No .obj files found in {MESHES_DIR}.")
-    print("Please add your cloth meshes to that folder and run again.")
-    raise SystemExit(1)
+# Defaults, overridable from the command line (see parse_args)
+NUM_SAMPLES = 1000  # Full training dataset
+MAX_WORKERS = N_PHYS  # one render process per physical core
+FILM_SIZE   = 512    # square output resolution; 512 is the ControlNet norm
+
+# DATASET_VERBOSE=1 re-enables the path diagnostics and the per-frame
+# progress lines. Off by default: a print per frame from every worker is
+# interleaved console spam at best, and stdout flushes serialise the
+# workers a little for nothing.
+VERBOSE = os.environ.get('DATASET_VERBOSE', '0') not in ('', '0')
+
+# Correlated multi-jittered sampling converges faster than independent
+# sampling on smooth integrands like these (variance closer to O(1/N^1.5)
+# than O(1/N)), so the sample counts drop roughly in half at matched noise:
+# 32 spp + OIDN, or 64 spp undenoised.
+SAMPLE_COUNT = 32 if HAVE_OIDN else 64
+
+# Each frame is rendered as SAMPLE_COUNT/SPP_PER_PASS averaged passes rather
+# than one big launch: peak memory scales with the pass size instead of the
+# full sample budget (noticeable under the ad variants, which keep sample
+# intermediates alive), and every pass re-executes the same cached kernel.
+# 16 is a 4x4 grid the multijitter sampler accepts without rounding.
+SPP_PER_PASS = 16
+
+# How many frames to schedule per dr.eval() flush on the JIT variants —
+# small enough that the in-flight film buffers stay cheap, large enough to
+# keep the backend busy while Python sets up the next frame
+RENDER_BATCH = 4
+
+# Light color temperature presets: warm / neutral / cool
+LIGHT_TEMPS = {
+    'warm':    [1.3, 1.0, 0.7],   # golden / sunset
+    'neutral': [1.0, 1.0, 1.0],   # neutral white
+    'cool':    [0.8, 0.9, 1.3],   # overcast / blue sky
+}
 
 # ---------------------------------------------------------------------------
-# 2. RENDER LOOP
+# 2. SCENE TEMPLATE & PARAMETER HELPERS
 # ---------------------------------------------------------------------------
-NUM_SAMPLES = 1000  # Full training dataset
-metadata_records = []
-
-
-existing = sum(
-    1 for j in range(NUM_SAMPLES)
-    if os.path.exists(os.path.join(RENDERS_DIR, f"render_{j:04d}.png"))
-    and os.path.exists(os.path.join(AO_DIR,      f"ao_{j:04d}.png"))
-)
-print(f"Checkpoint: {existing}/{NUM_SAMPLES} frames already done, resuming from where we left off.\n")
-
-for i in range(NUM_SAMPLES):
-    frame_str   = f"{i:04d}"
-    render_path = os.path.join(RENDERS_DIR, f"render_{frame_str}.png")
-    ao_path     = os.path.join(AO_DIR,      f"ao_{frame_str}.png")
-
-    # --- CHECKPOINT: skip frames that were already rendered ---
-    if os.path.exists(render_path) and os.path.exists(ao_path):
-        print(f"  [{i+1:>4}/{NUM_SAMPLES}] Skipping {frame_str} (already exists)")
-        continue
-
-    # --- Randomise Geometry ---
-    current_mesh_path = random.choice(mesh_files)
-    mesh_name = os.path.basename(current_mesh_path).replace(".obj", "")
-    
-    # Calculate bounding box for this specific mesh
-    shape_dict = {'type': 'obj', 'filename': current_mesh_path}
-    loaded_shape = mi.load_dict(shape_dict)
-    bbox = loaded_shape.bbox()
-    center = bbox.center()
-    extents = bbox.extents()
-    cx, cy, cz = float(center[0]), float(center[1]), float(center[2])
-
-    # DYNAMIC FRAMING: Calculate camera distance based on the largest dimension of the mesh
-    # This prevents the camera from clipping into large capes or being too far from small napkins
-    max_extent = max(extents[0], extents[1], extents[2])
-    # Base distance + random zoom factor — kept tight so cloth fills the frame
-    zoom_factor = random.uniform(0.6, 0.9)
-    cam_dist    = (max_extent * 1.0 + 1.0) * zoom_factor
-
-    # --- Randomise camera orbit (position on a hemisphere around the object) ---
-    cam_azimuth   = random.uniform(0.0, 360.0)      # horizontal orbit, full 360°
-    cam_elevation = random.uniform(10.0, 70.0)       # 10° (side) to 70° (near top-down)
-    fov           = random.uniform(25.0, 60.0)       # telephoto ↔ wide-angle
-
-
-    az_rad = math.radians(cam_azimuth)
-    el_rad = math.radians(cam_elevation)
-    cam_origin = [
-        cx + cam_dist * math.cos(el_rad) * math.sin(az_rad),
-        cy + cam_dist * math.sin(el_rad),
-        cz + cam_dist * math.cos(el_rad) * math.cos(az_rad),
-    ]
-
-    # --- Randomise lighting ---
-    # Key light: randomised direction
-    lx = random.uniform(-1.0, 1.0)
-    ly = random.uniform(-0.2, 1.0)   # mostly above the cloth
-    lz = random.uniform(-1.0, -0.1)
-
-    # Light color temperature: warm / neutral / cool
-    temp_choice = random.choice(['warm', 'neutral', 'cool'])
-    if temp_choice == 'warm':    lt = [1.3, 1.0, 0.7]   # golden / sunset
-    elif temp_choice == 'cool':  lt = [0.8, 0.9, 1.3]   # overcast / blue sky
-    else:                        lt = [1.0, 1.0, 1.0]   # neutral white
-
-    # Light intensity
-    intensity = random.uniform(1.5, 6.0)
-    key_irr   = [lt[0] * intensity, lt[1] * intensity, lt[2] * intensity]
-
-    # Fill light: dimmer, opposite side (always neutral white)
-    fill_intensity = intensity * random.uniform(0.1, 0.4)
-    fill_irr = [fill_intensity, fill_intensity, fill_intensity]
-
-    # --- Randomise mesh rotation ---
-    yaw   = random.uniform(0.0,   360.0)  # full turntable spin around Y axis
-    pitch = random.uniform(-20.0,  20.0)  # modest tilt so cloth stays visible
-
-    # Build transform: rotate around the mesh's own center so it stays framed
-    mesh_transform = (
-        mi.ScalarTransform4f.translate([cx, cy, cz])
-        @ mi.ScalarTransform4f.rotate(axis=[0, 1, 0], angle=yaw)
-        @ mi.ScalarTransform4f.rotate(axis=[1, 0, 0], angle=pitch)
-        @ mi.ScalarTransform4f.translate([-cx, -cy, -cz])
-    )
-
-    # --- Randomise material ---
-    roughness  = random.uniform(0.1, 0.9)   # 0.1 = shiny silk, 0.9 = matte wool
-    r, g, b    = (random.uniform(0.1, 0.9) for _ in range(3))
-    sheen      = random.uniform(0.0, 1.0)   # microfiber glow (velvet, towel, wool)
-    sheen_tint = random.uniform(0.0, 1.0)   # 0=white sheen, 1=tinted toward base color
-    anisotropic= random.uniform(0.0, 0.8)   # stretched highlights (woven fabric)
-    specular   = random.uniform(0.0, 1.0)   # surface specular intensity
-
-    material_desc = "shiny silk" if roughness < 0.4 else "matte wool"
-    prompt = (
-        f"a photorealistic 3D render of a {material_desc} cloth, "
-        "physical rendering, detailed fabric folds"
-    )
-
-    # --- Build scene with AOV integrator ---
-    scene = mi.load_dict({
+# The scene is loaded ONCE per mesh and then mutated through mi.traverse()
+# between frames. Rebuilding the scene dict per frame would re-parse the OBJ
+# and rebuild the BVH 1000 times; updating parameters in place skips all of
+# that and matches Mitsuba 3's standard parameter-update loop.
+
+def make_scene_dict(mesh_path):
+    """Scene template for one cloth mesh (OBJ, or a cached binary PLY).
+    Lighting/material/camera values are placeholders — every frame overwrites
+    them via the traversed parameters."""
+    mesh_type = 'ply' if mesh_path.endswith('.ply') else 'obj'
+    return {
         'type': 'scene',
 
         'integrator': {
@@ -160,96 +113,557 @@ for i in range(NUM_SAMPLES):
             'aovs': 'ao_channel:albedo',
             'my_path': {
                 'type': 'path',
-                'max_depth': 6,
+                # Two directional lights on a single opaque cloth: almost all
+                # of the image is direct light plus one or two inter-fold
+                # bounces, so deep paths only cost rays. Cap at 4 bounces and
+                # start Russian roulette immediately so the few surviving
+                # long paths terminate early.
+                'max_depth': 4,
+                'rr_depth': 2,
             },
         },
 
         'sensor': {
             'type': 'perspective',
-            'fov': fov,
+            'fov': 40.0,
             'to_world': mi.ScalarTransform4f.look_at(
-                origin=cam_origin,
-                target=[cx, cy, cz],
+                origin=[0, 0, 5],
+                target=[0, 0, 0],
                 up=[0, 1, 0]
             ),
             'film': {
                 'type': 'hdrfilm',
-                'width': 512,
-                'height': 512,
-                'pixel_format': 'rgba',
+                'width': FILM_SIZE,
+                'height': FILM_SIZE,
+                # 'rgb' not 'rgba': nothing downstream reads alpha, and the
+                # film then has one channel fewer to accumulate and copy out
+                'pixel_format': 'rgb',
             },
             'sampler': {
-                'type': 'independent',
-                'sample_count': 128,
+                'type': 'multijitter',
+                'sample_count': SPP_PER_PASS,
             },
         },
 
         # Key light
         'key_light': {
             'type': 'directional',
-            'direction': [lx, ly, lz],
-            'irradiance': {'type': 'rgb', 'value': key_irr},
+            'direction': [0.0, 0.5, -1.0],
+            'irradiance': {'type': 'rgb', 'value': [3.0, 3.0, 3.0]},
         },
 
         # Fill light (opposite horizontal direction, dimmer)
         'fill_light': {
             'type': 'directional',
-            'direction': [-lx, ly, -lz],
-            'irradiance': {'type': 'rgb', 'value': fill_irr},
+            'direction': [0.0, 0.5, 1.0],
+            'irradiance': {'type': 'rgb', 'value': [1.0, 1.0, 1.0]},
         },
 
         'cloth_object': {
-            'type': 'obj',
-            'filename': current_mesh_path,
-            'to_world': mesh_transform,
+            'type': mesh_type,
+            'filename': mesh_path,
             'bsdf': {
                 'type': 'principled',
-                'base_color':   {'type': 'rgb', 'value': [r, g, b]},
-                'roughness':    roughness,
-                'sheen':        sheen,
-                'sheen_tint':   sheen_tint,
-                'anisotropic':  anisotropic,
-                'specular':     specular,
+                'base_color':   {'type': 'rgb', 'value': [0.5, 0.5, 0.5]},
+                'roughness':    0.5,
+                'sheen':        0.5,
+                'sheen_tint':   0.5,
+                'anisotropic':  0.4,
+                'specular':     0.5,
             },
         },
-    })
+    }
 
-    # --- Render → multi-channel tensor (H, W, C) ---
-    render_np = np.array(mi.render(scene))
 
-    # ---- Save beauty render ----
-    beauty_np    = np.clip(render_np[:, :, :3], 0.0, 1.0)
-    beauty_uint8 = (beauty_np * 255).astype(np.uint8)
-    cv2.imwrite(render_path, cv2.cvtColor(beauty_uint8, cv2.COLOR_RGB2BGR))
+def light_to_world(direction):
+    """Directional emitters expose their orientation as a to_world transform
+    whose +Z axis is the light's travel direction (there is no 'direction'
+    entry in the traversed parameters)."""
+    dx, dy, dz = direction
+    norm = math.sqrt(dx * dx + dy * dy + dz * dz)
+    # Any up vector works as long as it is not parallel to the direction
+    up = [0, 1, 0] if abs(dy) < 0.99 * norm else [1, 0, 0]
+    return mi.ScalarTransform4f.look_at(origin=[0, 0, 0], target=direction, up=up)
 
-    # ---- Save AO pass ----
-    if render_np.shape[2] >= 7:
-        ao_rgb  = render_np[:, :, 4:7]
-        ao_gray = np.mean(ao_rgb, axis=2)
-    else:
-        print(f"  [WARNING] AOV channels not found for frame {frame_str}; using luminance as AO proxy.")
-        ao_gray = np.mean(render_np[:, :, :3], axis=2)
 
-    ao_uint8 = (np.clip(ao_gray, 0.0, 1.0) * 255).astype(np.uint8)
-    cv2.imwrite(ao_path, ao_uint8)
+# ---------------------------------------------------------------------------
+# 3. PER-WORKER RENDER FUNCTION
+# ---------------------------------------------------------------------------
+# Frames are grouped by mesh and each group is rendered by one worker process
+# (frames are fully independent, so the dataset is embarrassingly parallel).
+# Every task is self-contained — mesh path, bbox, and per-frame parameter
+# specs travel with it — so workers do not rely on inherited module state.
+
+def _init_worker(num_samples, sample_count, film_size, max_workers):
+    # Worker processes re-import this module and would otherwise see the
+    # module defaults — push the (possibly CLI-overridden) settings across.
+    global NUM_SAMPLES, SAMPLE_COUNT, FILM_SIZE, MAX_WORKERS
+    NUM_SAMPLES  = num_samples
+    SAMPLE_COUNT = sample_count
+    FILM_SIZE    = film_size
+    MAX_WORKERS  = max_workers
+    # Each worker is one render process; don't let every one of them also
+    # spin up a machine-wide Dr.Jit/nanothread pool on top of that.
+    dr.set_thread_count(max(1, N_PHYS // MAX_WORKERS))
+
+
+# Image encoding is CPU work that would otherwise run serially between
+# renders. Push writes onto a small thread pool so the next frame's render
+# overlaps with the previous frame's encode. Beauty renders go out as
+# lossless WebP, which encodes several times faster than libpng and is
+# smaller on disk; the single-channel AO pass stays PNG (it deflates well)
+# at compression level 1 — training data doesn't need maximum compression.
+WEBP_LOSSLESS = [cv2.IMWRITE_WEBP_QUALITY, 101]
+PNG_FAST      = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+io_pool  = ThreadPoolExecutor(max_workers=2)
+
+# Rec. 709 luminance weights, used to collapse the tinted albedo AOV to gray
+LUMA_WEIGHTS = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+# Per-worker OIDN state: one device and one RT filter, bound once to
+# persistent in/out buffers so frames only memcpy into them and execute
+_oidn_state = None
+
+
+def get_denoiser(h, w):
+    """Lazily build the per-worker OIDN RT filter. The filter is committed
+    once against fixed color/albedo/output buffers; callers fill the buffers
+    and call oidn.ExecuteFilter. The albedo AOV (already rendered for the AO
+    pass) acts as an auxiliary guide so edges survive the filtering."""
+    global _oidn_state
+    if _oidn_state is None:
+        dev = oidn.NewDevice()
+        oidn.CommitDevice(dev)
+        color  = np.empty((h, w, 3), np.float32)
+        albedo = np.empty((h, w, 3), np.float32)
+        out    = np.empty((h, w, 3), np.float32)
+        flt    = oidn.NewFilter(dev, "RT")
+        oidn.SetSharedFilterImage(flt, "color",  color,  oidn.FORMAT_FLOAT3, w, h)
+        oidn.SetSharedFilterImage(flt, "albedo", albedo, oidn.FORMAT_FLOAT3, w, h)
+        oidn.SetSharedFilterImage(flt, "output", out,    oidn.FORMAT_FLOAT3, w, h)
+        oidn.CommitFilter(flt)
+        _oidn_state = (flt, color, albedo, out)
+    return _oidn_state
+
+
+def _launch_frame(scene, params, base_positions, i, spec):
+    """Push one frame's parameters into the shared scene and kick off its
+    render. Returns the (possibly still lazy) image tensor; the caller is
+    responsible for evaluating and converting it."""
+    # --- Lighting ---
+    lx, ly, lz = spec['light_dir']
+    lt         = LIGHT_TEMPS[spec['temp']]
+    intensity  = spec['intensity']
+    key_irr    = [lt[0] * intensity, lt[1] * intensity, lt[2] * intensity]
+
+    # Fill light: dimmer, opposite side (always neutral white)
+    fill_intensity = intensity * spec['fill_scale']
+    fill_irr = [fill_intensity, fill_intensity, fill_intensity]
+
+    # Mesh rotation: transform the rest-pose vertices with the rotation /
+    # translation precomputed on the batched path in main() (Mitsuba
+    # recomputes normals and refits the BVH on params.update()).
+    R = np.asarray(spec['mesh_rot'],   dtype=np.float32)
+    t = np.asarray(spec['mesh_trans'], dtype=np.float32)
+    params['cloth_object.vertex_positions'] = \
+        (base_positions @ R.T + t).ravel()
+
+    # Camera orbit: the full to_world matrix is precomputed on the batched
+    # path in main(), so there is no per-frame look_at here
+    params['sensor.x_fov']    = spec['fov']
+    params['sensor.to_world'] = mi.ScalarTransform4f(spec['cam_to_world'])
+
+    params['key_light.to_world']          = light_to_world([lx, ly, lz])
+    params['key_light.irradiance.value']  = key_irr
+    params['fill_light.to_world']         = light_to_world([-lx, ly, -lz])
+    params['fill_light.irradiance.value'] = fill_irr
+
+    r, g, b = spec['rgb']
+    params['cloth_object.bsdf.base_color.value']  = [r, g, b]
+    params['cloth_object.bsdf.roughness.value']   = spec['roughness']
+    params['cloth_object.bsdf.sheen.value']       = spec['sheen']
+    params['cloth_object.bsdf.sheen_tint.value']  = spec['sheen_tint']
+    params['cloth_object.bsdf.anisotropic.value'] = spec['anisotropic']
+    params['cloth_object.bsdf.specular']          = spec['specular']
+
+    params.update()
+
+    # Accumulate the sample budget in fixed-size passes, each with its own
+    # seed so the passes (and frames) stay statistically independent. The
+    # average is left lazy; dr.schedule marks it for the next dr.eval()
+    # flush (a no-op under the scalar variant, which evaluates eagerly).
+    n_passes = max(1, SAMPLE_COUNT // SPP_PER_PASS)
+    img = mi.render(scene, seed=i * n_passes, spp=SPP_PER_PASS)
+    for p in range(1, n_passes):
+        img = img + mi.render(scene, seed=i * n_passes + p, spp=SPP_PER_PASS)
+    if n_passes > 1:
+        img = img / n_passes
+    dr.schedule(img)
+    return img
+
+
+def render_mesh_group(task):
+    """Render all frames of one mesh group. Returns the metadata records of
+    the frames actually rendered."""
+    current_mesh_path, mesh_binary_path, frames = task
+    mesh_name = os.path.basename(current_mesh_path).replace(".obj", "")
+    records = []
+    writes  = []
 
-    # ---- Record metadata ----
-    metadata_records.append({
-        "file_name":          f"renders/render_{frame_str}.png",
-        "conditioning_image": f"conditioning/conditioning_{frame_str}.png",
-        "ao_image":           f"ao/ao_{frame_str}.png",
-        "text":               prompt,
-    })
+    # --- CHECKPOINT: skip frames that were already rendered ---
+    pending = [
+        (i, spec) for i, spec in frames
+        if not (os.path.exists(os.path.join(RENDERS_DIR, f"render_{i:04d}.webp"))
+                and os.path.exists(os.path.join(AO_DIR,   f"ao_{i:04d}.png")))
+    ]
+    if not pending:
+        if VERBOSE:
+            print(f"  Skipping mesh {mesh_name}: all {len(frames)} frame(s) already exist")
+        return records
+
+    # --- Build the scene ONCE for this mesh, from the binary cache ---
+    scene  = mi.load_dict(make_scene_dict(mesh_binary_path))
+    params = mi.traverse(scene)
+
+    # Untransformed vertex buffer — every frame's rotation is applied to this
+    base_positions = np.array(params['cloth_object.vertex_positions'],
+                              dtype=np.float32).reshape(-1, 3)
+
+    # Reusable float scratch buffers, allocated on the first frame. The
+    # post-processing chain otherwise churns ~20 MB of fresh allocations per
+    # frame; reusing keeps the working set hot in cache. (The final uint8
+    # images stay freshly allocated — they are handed to the async writer.)
+    beauty_f32 = None
+    ao_f32     = None
+
+    # Under the JIT variants, renders are lazy tensors: schedule a few frames,
+    # flush them to the backend in one dr.eval(), and only then pull the
+    # results across to NumPy. That keeps the compile/dispatch pipeline full
+    # instead of draining it after every frame. The scalar variant renders
+    # eagerly, so there a "batch" of 1 is just the old loop.
+    batch_size = RENDER_BATCH if mi.variant().startswith(('llvm_', 'cuda_')) else 1
+
+    for start in range(0, len(pending), batch_size):
+        batch = []
+
+        # --- Phase 1: push parameters and launch the renders ---
+        for i, spec in pending[start:start + batch_size]:
+            batch.append((i, spec, _launch_frame(scene, params, base_positions, i, spec)))
+        dr.eval()
+
+        # --- Phase 2: post-process and write out ---
+        for i, spec, img in batch:
+            frame_str   = f"{i:04d}"
+            render_path = os.path.join(RENDERS_DIR, f"render_{frame_str}.webp")
+            ao_path     = os.path.join(AO_DIR,      f"ao_{frame_str}.png")
+
+            render_np = np.array(img)
+
+            material_desc = "shiny silk" if spec['roughness'] < 0.4 else "matte wool"
+            prompt = (
+                f"a photorealistic 3D render of a {material_desc} cloth, "
+                "physical rendering, detailed fabric folds"
+            )
+
+            # ---- Save beauty render ----
+            # Slice the channels in BGR order during the (unavoidable) copy out
+            # of the multi-channel AOV tensor — imwrite wants BGR anyway, so the
+            # old cvtColor round-trip allocated an extra buffer for nothing.
+            # convertScaleAbs then fuses the clip (via saturation), 255x scale
+            # and uint8 cast into one SIMD pass instead of three NumPy traversals
+            if beauty_f32 is None:
+                h, w       = render_np.shape[:2]
+                beauty_f32 = np.empty((h, w, 3), np.float32)
+                ao_f32     = np.empty((h, w), np.float32)
+
+            if HAVE_OIDN:
+                flt, dn_color, dn_albedo, dn_out = get_denoiser(*render_np.shape[:2])
+                np.copyto(dn_color, render_np[:, :, :3])
+                if render_np.shape[2] >= 6:
+                    np.copyto(dn_albedo, render_np[:, :, 3:6])
+                else:
+                    dn_albedo.fill(1.0)   # no AOV: flat guide, color-only denoise
+                oidn.ExecuteFilter(flt)
+                np.copyto(beauty_f32, dn_out[:, :, ::-1])
+            else:
+                np.copyto(beauty_f32, render_np[:, :, 2::-1])
+            beauty_uint8 = cv2.convertScaleAbs(beauty_f32, alpha=255.0)
+            # Fresh buffer every frame, so the async write needs no defensive copy
+            writes.append(io_pool.submit(cv2.imwrite, render_path, beauty_uint8, WEBP_LOSSLESS))
+
+            # ---- Save AO pass ----
+            # The AOV is albedo, so its channels carry the random base_color
+            # tint — a single plane would couple the fold-shading brightness
+            # to the cloth's red component. Collapse hue with a Rec. 709
+            # luminance dot instead: one fused pass, and the resulting gray
+            # matches perceived brightness rather than the channel mean.
+            # (The matmul output also lands contiguous for OpenCV.)
+            if render_np.shape[2] >= 6:
+                np.matmul(render_np[:, :, 3:6], LUMA_WEIGHTS, out=ao_f32)
+            else:
+                print(f"  [WARNING] AOV channels not found for frame {frame_str}; using luminance as AO proxy.")
+                np.matmul(render_np[:, :, :3], LUMA_WEIGHTS, out=ao_f32)
+
+            writes.append(io_pool.submit(
+                cv2.imwrite, ao_path, cv2.convertScaleAbs(ao_f32, alpha=255.0), PNG_FAST))
+
+            # ---- Record metadata ----
+            records.append({
+                "file_name":          f"renders/render_{frame_str}.webp",
+                "conditioning_image": f"conditioning/conditioning_{frame_str}.png",
+                "ao_image":           f"ao/ao_{frame_str}.png",
+                "text":               prompt,
+            })
+
+            if VERBOSE:
+                print(f"  [{i+1:>4}/{NUM_SAMPLES}] Saved {frame_str} | Mesh: {mesh_name[:15]} | {material_desc}")
+
+    # Block until this group's images are all on disk before reporting done —
+    # the checkpoint logic treats a file's existence as proof of completion
+    for w in writes:
+        if not w.result():
+            print(f"  [ERROR] An image write failed for mesh {mesh_name}.")
+
+    return records
 
-    print(f"  [{i+1:>3}/{NUM_SAMPLES}] Saved {frame_str} | Mesh: {mesh_name[:15]} | {material_desc}")
 
 # ---------------------------------------------------------------------------
-# 3. WRITE METADATA
+# 4. MAIN: PLAN FRAMES, FAN OUT, WRITE METADATA
 # ---------------------------------------------------------------------------
-metadata_path = os.path.join(DATASET_DIR, "metadata.jsonl")
-with open(metadata_path, 'w') as f:
-    for record in metadata_records:
-        f.write(json.dumps(record) + '\n')
+def parse_args():
+    ap = argparse.ArgumentParser(
+        description="Render the beauty/AO training pairs for the ControlNet "
+                    "dataset (Stage 1 of the pipeline).")
+    ap.add_argument('--num-samples', type=int, default=NUM_SAMPLES,
+                    help="number of frames to render (default: %(default)s)")
+    ap.add_argument('--spp', type=int, default=SAMPLE_COUNT,
+                    help="per-frame sample budget; rounded down to a multiple "
+                         f"of the {SPP_PER_PASS}-spp pass size "
+                         "(default: %(default)s)")
+    ap.add_argument('--size', type=int, default=FILM_SIZE,
+                    help="square output resolution (default: %(default)s)")
+    ap.add_argument('--workers', type=int, default=MAX_WORKERS,
+                    help="render processes (default: one per physical core)")
+    return ap.parse_args()
+
+
+def main():
+    # Quality/time sweeps come through the CLI so nobody edits constants and
+    # re-saves the script between trials
+    args = parse_args()
+    global NUM_SAMPLES, SAMPLE_COUNT, FILM_SIZE, MAX_WORKERS
+    NUM_SAMPLES  = args.num_samples
+    SAMPLE_COUNT = max(SPP_PER_PASS, args.spp - args.spp % SPP_PER_PASS)
+    FILM_SIZE    = args.size
+    MAX_WORKERS  = max(1, args.workers)
+
+    # Discover all .obj files in the meshes directory
+    mesh_files = sorted(glob.glob(os.path.join(MESHES_DIR, "*.obj")))
+
+    if VERBOSE:
+        print("--- PATH DIAGNOSTICS ---")
+        print(f"Mitsuba variant: {mi.variant()}")
+        print(f"Meshes dir : {MESHES_DIR}")
+        print(f"  Found    : {len(mesh_files)} .obj file(s)")
+        print(f"Renders dir: {RENDERS_DIR}")
+        print(f"AO dir     : {AO_DIR}")
+        print("------------------------\n")
+
+    if not mesh_files:
+        print(f"[ERROR] No .obj files found in {MESHES_DIR}.")
+        print("Please add your cloth meshes to that folder and run again.")
+        raise SystemExit(1)
+
+    existing = sum(
+        1 for j in range(NUM_SAMPLES)
+        if os.path.exists(os.path.join(RENDERS_DIR, f"render_{j:04d}.webp"))
+        and os.path.exists(os.path.join(AO_DIR,      f"ao_{j:04d}.png"))
+    )
+    print(f"Checkpoint: {existing}/{NUM_SAMPLES} frames already done, resuming from where we left off.\n")
+
+    # --- Preload: bounding box + binary mesh cache per unique mesh ---
+    # Camera framing only needs 6 floats per mesh, so compute them once up
+    # front instead of touching the OBJ again inside the render loop. While
+    # the mesh is in memory anyway, write it out as binary PLY (if not cached
+    # yet) so the render workers never pay the OBJ text parse again. The bbox
+    # values are persisted alongside the PLYs, keyed by the same content
+    # hash, so warm runs skip loading the meshes in main() altogether.
+    os.makedirs(MESH_CACHE_DIR, exist_ok=True)
+    bbox_cache_path = os.path.join(MESH_CACHE_DIR, "bbox_cache.json")
+    try:
+        with open(bbox_cache_path) as f:
+            bbox_cache = json.load(f)
+    except (OSError, ValueError):
+        bbox_cache = {}
+
+    mesh_bbox_cache = {}
+    mesh_binary     = {}
+    bbox_cache_dirty = False
+    for p in mesh_files:
+        with open(p, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()[:12]
+        stem     = os.path.splitext(os.path.basename(p))[0]
+        ply_path = os.path.join(MESH_CACHE_DIR, f"{stem}.{digest}.ply")
+
+        # Workers resolve this relative name through the file resolver
+        rel_ply = os.path.relpath(ply_path, MESHES_DIR)
+
+        cached = bbox_cache.get(digest)
+        if cached is not None and os.path.exists(ply_path):
+            mesh_bbox_cache[p] = (tuple(cached[0]), tuple(cached[1]))
+            mesh_binary[p]     = rel_ply
+            continue
+
+        if os.path.exists(ply_path):
+            shape = mi.load_dict({'type': 'ply', 'filename': ply_path})
+        else:
+            # Drop cache entries from earlier versions of this mesh
+            for stale in glob.glob(os.path.join(MESH_CACHE_DIR, f"{stem}.*.ply")):
+                os.remove(stale)
+            shape = mi.load_dict({'type': 'obj', 'filename': p})
+            shape.write_ply(ply_path)
+
+        bb = shape.bbox()
+        mesh_bbox_cache[p] = (tuple(bb.center()), tuple(bb.extents()))
+        mesh_binary[p]     = rel_ply
+        bbox_cache[digest] = [list(mesh_bbox_cache[p][0]),
+                              list(mesh_bbox_cache[p][1])]
+        bbox_cache_dirty = True
+        del shape  # drop the triangle buffers; only the 6 floats are kept
+
+    if bbox_cache_dirty:
+        with open(bbox_cache_path, 'w') as f:
+            json.dump(bbox_cache, f)
+
+    # --- Pre-draw ALL per-frame randomness in a few NumPy passes ---
+    # One seeded generator makes the whole dataset reproducible and
+    # inspectable, and replaces ~10 Python-level random.uniform calls per
+    # frame with vectorized batch draws.
+    N   = NUM_SAMPLES
+    rng = np.random.default_rng(42)
+
+    mesh_idx    = rng.integers(len(mesh_files), size=N)
+    zoom        = rng.uniform(0.6, 0.9, N)           # camera zoom factor
+    cam_az      = rng.uniform(0.0, 360.0, N)         # horizontal orbit, full 360°
+    cam_el      = rng.uniform(10.0, 70.0, N)         # 10° (side) to 70° (near top-down)
+    fov         = rng.uniform(25.0, 60.0, N)         # telephoto ↔ wide-angle
+    light_dir   = np.stack([rng.uniform(-1.0,  1.0, N),
+                            rng.uniform(-0.2,  1.0, N),    # mostly above the cloth
+                            rng.uniform(-1.0, -0.1, N)], axis=1)
+    temp        = rng.choice(list(LIGHT_TEMPS), N)   # warm / neutral / cool
+    intensity   = rng.uniform(1.5, 6.0, N)           # key light intensity
+    fill_scale  = rng.uniform(0.1, 0.4, N)           # fill relative to key
+    yaw         = rng.uniform(0.0, 360.0, N)         # full turntable spin around Y axis
+    pitch       = rng.uniform(-20.0, 20.0, N)        # modest tilt so cloth stays visible
+    roughness   = rng.uniform(0.1, 0.9, N)           # 0.1 = shiny silk, 0.9 = matte wool
+    base_color  = rng.uniform(0.1, 0.9, (N, 3))
+    sheen       = rng.uniform(0.0, 1.0, N)           # microfiber glow (velvet, towel, wool)
+    sheen_tint  = rng.uniform(0.0, 1.0, N)           # 0=white sheen, 1=tinted toward base color
+    anisotropic = rng.uniform(0.0, 0.8, N)           # stretched highlights (woven fabric)
+    specular    = rng.uniform(0.0, 1.0, N)           # surface specular intensity
+
+    # --- Vectorized camera placement ---
+    # cam distance depends on the chosen mesh's extent, and the orbit maths is
+    # one batched trig pass here instead of per-frame math.sin/cos/radians
+    centers     = np.array([mesh_bbox_cache[mesh_files[k]][0] for k in mesh_idx])
+    max_extents = np.array([max(mesh_bbox_cache[mesh_files[k]][1]) for k in mesh_idx])
+    # Base distance + zoom factor — kept tight so cloth fills the frame
+    cam_dist    = (max_extents * 1.0 + 1.0) * zoom
+    az_rad      = np.radians(cam_az)
+    el_rad      = np.radians(cam_el)
+    cam_origin  = centers + cam_dist[:, None] * np.stack([
+        np.cos(el_rad) * np.sin(az_rad),
+        np.sin(el_rad),
+        np.cos(el_rad) * np.cos(az_rad),
+    ], axis=1)
+
+    # Assemble the full camera to_world matrices here as well, replicating
+    # look_at's frame (+Z toward the target, [0,1,0] as the up hint — never
+    # parallel to the view direction since elevation stays below 90 deg).
+    # The workers then wrap the finished matrix instead of redoing the cross
+    # products and normalisations per frame.
+    cam_fwd    = centers - cam_origin
+    cam_fwd   /= np.linalg.norm(cam_fwd, axis=1, keepdims=True)
+    cam_right  = np.cross([0.0, 1.0, 0.0], cam_fwd)
+    cam_right /= np.linalg.norm(cam_right, axis=1, keepdims=True)
+    cam_up     = np.cross(cam_fwd, cam_right)
+    cam_to_world = np.zeros((N, 4, 4))
+    cam_to_world[:, :3, 0] = cam_right
+    cam_to_world[:, :3, 1] = cam_up
+    cam_to_world[:, :3, 2] = cam_fwd
+    cam_to_world[:, :3, 3] = cam_origin
+    cam_to_world[:,  3, 3] = 1.0
+
+    # --- Vectorized mesh rotation matrices ---
+    # Each frame spins the mesh around its own center: T(c) Ry(yaw) Rx(pitch)
+    # T(-c). Building all N rotation matrices in one trig pass here means the
+    # workers just do one matmul per frame instead of composing four
+    # ScalarTransform4f objects through the Python bindings.
+    yaw_rad   = np.radians(yaw)
+    pitch_rad = np.radians(pitch)
+    cy_, sy_  = np.cos(yaw_rad),   np.sin(yaw_rad)
+    cp_, sp_  = np.cos(pitch_rad), np.sin(pitch_rad)
+    mesh_rot = np.empty((N, 3, 3))                   # Ry(yaw) @ Rx(pitch)
+    mesh_rot[:, 0, 0] = cy_
+    mesh_rot[:, 0, 1] = sy_ * sp_
+    mesh_rot[:, 0, 2] = sy_ * cp_
+    mesh_rot[:, 1, 0] = 0.0
+    mesh_rot[:, 1, 1] = cp_
+    mesh_rot[:, 1, 2] = -sp_
+    mesh_rot[:, 2, 0] = -sy_
+    mesh_rot[:, 2, 1] = cy_ * sp_
+    mesh_rot[:, 2, 2] = cy_ * cp_
+    # Conjugating by T(±c) collapses to a translation of c - R·c
+    mesh_trans = centers - np.einsum('nij,nj->ni', mesh_rot, centers)
+
+    frame_specs = [{
+        'cam_to_world': cam_to_world[i].tolist(),
+        'fov':         float(fov[i]),
+        'light_dir':   light_dir[i].tolist(),
+        'temp':        str(temp[i]),
+        'intensity':   float(intensity[i]),
+        'fill_scale':  float(fill_scale[i]),
+        'yaw':         float(yaw[i]),
+        'pitch':       float(pitch[i]),
+        'mesh_rot':    mesh_rot[i].tolist(),
+        'mesh_trans':  mesh_trans[i].tolist(),
+        'roughness':   float(roughness[i]),
+        'rgb':         base_color[i].tolist(),
+        'sheen':       float(sheen[i]),
+        'sheen_tint':  float(sheen_tint[i]),
+        'anisotropic': float(anisotropic[i]),
+        'specular':    float(specular[i]),
+    } for i in range(N)]
+
+    # Group frames by mesh so each mesh is loaded (and its BVH built)
+    # exactly once per worker
+    mesh_groups = {}
+    for i, k in enumerate(mesh_idx):
+        mesh_groups.setdefault(mesh_files[k], []).append((i, frame_specs[i]))
+
+    tasks = [
+        (p, mesh_binary[p], frames)
+        for p, frames in mesh_groups.items()
+    ]
+
+    metadata_records = []
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=_init_worker,
+                             initargs=(NUM_SAMPLES, SAMPLE_COUNT,
+                                       FILM_SIZE, MAX_WORKERS)) as ex:
+        for records in ex.map(render_mesh_group, tasks):
+            metadata_records.extend(records)
+
+    # Workers finish out of order — keep the JSONL sorted by frame number
+    metadata_records.sort(key=lambda rec: rec["file_name"])
+
+    metadata_path = os.path.join(DATASET_DIR, "metadata.jsonl")
+    with open(metadata_path, 'w') as f:
+        for record in metadata_records:
+            f.write(json.dumps(record) + '\n')
+
+    print(f"\n✓ Done! {NUM_SAMPLES} render pairs saved.")
+    print("\nNext: run  python generate_sketches.py  to create the conditioning inputs.")
+
 
-print(f"\n✓ Done! {NUM_SAMPLES} render pairs saved.")
-print("\nNext: run  python generate_sketches.py  to create the conditioning inputs.")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
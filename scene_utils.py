@@ -0,0 +1,71 @@
+"""
+scene_utils.py
+--------------
+Shared Mitsuba/Dr.Jit setup for the pipeline scripts.
+
+Every script in this repo needs the same boilerplate before it can render:
+pick the fastest variant that initialises on this machine, size the Dr.Jit
+thread pool, pin the kernel-reuse flags, and register asset directories with
+the file resolver. init_mitsuba() bundles those steps so new scripts (and
+the render worker processes, which re-import their parent module) stay in
+sync with a single implementation.
+"""
+
+import os
+
+# Pin any OpenMP-backed thread pools (OpenCV, OIDN) to physical cores with
+# close placement — must be exported before the libraries load. Respect
+# values the user already set.
+os.environ.setdefault('OMP_PLACES', 'cores')
+os.environ.setdefault('OMP_PROC_BIND', 'close')
+
+import mitsuba as mi
+import drjit as dr
+
+# Approximate physical core count: on hyper-threaded CPUs, running one
+# render thread per *logical* core makes sibling threads fight over the same
+# L1/L2 for no extra arithmetic throughput — path tracing is cache-hungry,
+# not stall-bound. os.cpu_count() reports logical cores, so halve it.
+N_PHYS = max(1, os.cpu_count() // 2)
+
+
+def init_mitsuba(prefer=('cuda_ad_rgb', 'llvm_ad_rgb', 'scalar_rgb'),
+                 thread_count=N_PHYS, resolver_paths=()):
+    """Initialise Mitsuba for this process and return the selected variant.
+
+    Variant preference: CUDA first (hardware BVH traversal, when a
+    compatible build and GPU are present), then the LLVM JIT (Dr.Jit
+    vectorizes path samples across SIMD lanes), then the scalar interpreter
+    as the always-works fallback. MI_VARIANT=... prepends a variant to the
+    preference order — handy for pinning 'scalar_rgb' on machines where a
+    JIT backend miscompiles, without editing any script.
+    """
+    prefs = tuple(prefer)
+    if os.environ.get('MI_VARIANT'):
+        prefs = (os.environ['MI_VARIANT'],) + prefs
+    for variant in prefs:
+        try:
+            mi.set_variant(variant)
+            break
+        except (ImportError, RuntimeError, AttributeError):
+            continue
+
+    dr.set_thread_count(thread_count)
+
+    # On the JIT variants, repeat mi.render calls share one kernel structure
+    # — only parameter values change. Dr.Jit reuses the compiled megakernel
+    # between those calls as long as symbolic recording and kernel freezing
+    # are on; set them explicitly (they are the modern defaults, but the
+    # names/defaults have moved between Dr.Jit releases) so renders 2..N
+    # never pay the JIT compile again.
+    if mi.variant() != 'scalar_rgb':
+        for flag in ('SymbolicLoops', 'SymbolicCalls', 'KernelFreezing'):
+            if hasattr(dr.JitFlag, flag):
+                dr.set_flag(getattr(dr.JitFlag, flag), True)
+
+    # Asset directories: scene dicts can then reference files by relative
+    # name and the loader opens them through its own stream machinery.
+    for path in resolver_paths:
+        mi.file_resolver().append(path)
+
+    return mi.variant()